@@ -1,73 +1,232 @@
 """Simple script to manipulate images in a PDF file."""
 import argparse
-import base64
+import asyncio
+import gc
+import hashlib
 import io
 import os
+import re
+import shelve
+from concurrent.futures import ThreadPoolExecutor
 import fitz
-import requests
+import httpx
 from PIL import Image, ImageFilter, ImageFont, ImageDraw
 
+# pybase64 is optional, it is a faster (SIMD) implementation of b64encode
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
 
-def get_image_description(image_path, prompt, model, openai_key, max_tokens, is_verbose=False):
+# orjson is optional, it is used for a faster serialization of the OpenAI requests and responses
+try:
+    from orjson import dumps as _dumps, loads as _loads
+except ImportError:
+    from json import dumps as _dumps, loads as _loads
+
+# NumPy and OpenCV are optional, they are only used for a faster black/white conversion and blur
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+# The OpenAI model used to describe the images
+VISION_MODEL = "gpt-4-vision-preview"
+
+# Matches one entry of a numbered list, e.g. "1) A dog" or "2. Two people"
+NUMBERED_LINE = re.compile(r'^\s*\d+[\).]\s*(.+)$')
+
+
+async def describe_async(client, semaphore, images_bytes, prompt, model, max_tokens,
+                         detail="low", is_verbose=False, max_attempts=3):
     """Gets an image description using OpenAI's API.
 
     Args:
-        image_path (str): The path to the image.
+        client (httpx.AsyncClient): The client used to send the request (with the auth headers).
+        semaphore (asyncio.Semaphore): Limits the number of requests in flight.
+        images_bytes (list): The JPEG encoded images (bytes), all sent in the same request.
         prompt (str): The prompt to use.
         model (str): The model to use.
-        openai_key (str): The OpenAI key. You can get one at https://platform.openai.com/api-keys
         max_tokens (int): The maximum number of tokens to be used (per request, e.g. per image!)
+        detail (str): The level of detail the model uses for the image ("low", "high" or "auto").
         is_verbose (bool): Whether to print debug information.
+        max_attempts (int): How often to try the request on rate limits (429) and server errors (5xx).
 
     Returns:
-        str: The description of the image."""
-
-    # Check if the image path is valid
-    if not os.path.exists(image_path):
-        print(f"Error: The image path '{image_path}' does not exist.")
-        return
+        str: The description of the image(s)."""
+
+    # Encode the images to base64
+    content = [{"type": "text", "text": prompt}]
+    for image_bytes in images_bytes:
+        base64_image = _b64.b64encode(image_bytes).decode("ascii")
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}",
+                                                           "detail": detail}})
+
+    # Make the request to OpenAI's API
+    payload = {
+        "model": model,
+        "messages": [{
+            "role": "user",
+            "content": content
+        }],
+        "max_tokens": max_tokens
+    }
 
     try:
-        # Encode the image to base64
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-
-        # Make the request to OpenAI's API
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {openai_key}"
-        }
-
-        payload = {
-            "model": model,
-            "messages": [{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                ]
-            }],
-            "max_tokens": max_tokens
-        }
-
-        response = requests.post(url="https://api.openai.com/v1/chat/completions",
-                                 headers=headers,
-                                 json=payload)
+        async with semaphore:
+            for attempt in range(max_attempts):
+                response = await client.post(url="https://api.openai.com/v1/chat/completions",
+                                             content=_dumps(payload))
+                # Retry with exponential backoff on rate limits and server errors
+                if response.status_code == 429 or response.status_code >= 500:
+                    if attempt < max_attempts - 1:
+                        delay = 2 ** attempt
+                        if is_verbose:
+                            print(f"describe_async::Status {response.status_code}, retrying in {delay}s")
+                        await asyncio.sleep(delay)
+                        continue
+                response.raise_for_status()
+                response = _loads(response.content)
+                break
 
         # Get the description from the response
-        response = response.json()
         if is_verbose:
-            print(f"get_image_description::Response: {response}")
+            print(f"describe_async::Response: {response}")
         description = response['choices'][0]['message']['content']
         return description
-    except Exception as e:
-        print("get_image_description::Error:", e)
-        return ""
     except KeyError:
-        print(f"get_image_description::Key Error in response")
+        print("describe_async::Key Error in response")
+        return ""
+    except Exception as e:
+        print("describe_async::Error:", e)
         return ""
 
 
+async def describe_batch_async(client, semaphore, images_bytes, prompt, model, max_tokens,
+                               detail="low", is_verbose=False):
+    """Describes several images with a single request to OpenAI's API.
+
+    The model is asked for a numbered list with one description per image. If the answer can't
+    be parsed, every image is described with its own request. If the request fails, all
+    descriptions are empty.
+
+    Args:
+        client (httpx.AsyncClient): The client used to send the request (with the auth headers).
+        semaphore (asyncio.Semaphore): Limits the number of requests in flight.
+        images_bytes (list): The JPEG encoded images (bytes).
+        prompt (str): The prompt to use for each image.
+        model (str): The model to use.
+        max_tokens (int): The maximum number of tokens to be used per image.
+        detail (str): The level of detail the model uses for the images ("low", "high" or "auto").
+        is_verbose (bool): Whether to print debug information.
+
+    Returns:
+        list: The descriptions of the images, in the same order."""
+
+    if len(images_bytes) > 1:
+        batch_prompt = (f"{prompt}\nDo this for each of the following {len(images_bytes)} images separately. "
+                        f"Output as: 1) ... 2) ...")
+        reply = await describe_async(client, semaphore, images_bytes, batch_prompt, model,
+                                     max_tokens * len(images_bytes), detail=detail, is_verbose=is_verbose)
+        # An empty reply means the request failed, separate requests would fail the same way
+        if not reply:
+            return [""] * len(images_bytes)
+        descriptions = [match.group(1).strip() for match in map(NUMBERED_LINE.match, reply.splitlines())
+                        if match]
+        if len(descriptions) == len(images_bytes):
+            return descriptions
+        if is_verbose:
+            print("describe_batch_async::Could not parse the response, describing the images one by one")
+
+    return await asyncio.gather(*[describe_async(client, semaphore, [image_bytes], prompt, model, max_tokens,
+                                                 detail=detail, is_verbose=is_verbose)
+                                  for image_bytes in images_bytes])
+
+
+async def describe_images(images, args):
+    """Describes a list of images concurrently.
+
+    Args:
+        images (list): A list of (key, image_bytes) tuples.
+        args (argparse.Namespace): The arguments from the command line.
+
+    Returns:
+        dict: The descriptions, keyed by the keys of the images."""
+
+    # The headers are the same for all requests, so they are set once on the client.
+    # The OpenAI key can be created at https://platform.openai.com/api-keys
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {args.openai_key}"
+    }
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    # With HTTP/2 all requests share the connection (and the TLS handshake)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(http2=True, headers=headers, limits=limits, timeout=60.0) as client:
+        tasks = []
+        batch_size = args.describe_batch_size
+        for start in range(0, len(images), batch_size):
+            tasks.append(describe_batch_async(client, semaphore,
+                                              [image_bytes for _, image_bytes in images[start:start + batch_size]],
+                                              args.description_prompt,
+                                              VISION_MODEL,
+                                              args.max_openai_tokens,
+                                              detail=args.vision_detail,
+                                              is_verbose=args.verbose))
+        batches = await asyncio.gather(*tasks)
+
+    descriptions = [description for batch in batches for description in batch]
+    return {key: description for (key, _), description in zip(images, descriptions)}
+
+
+class DescriptionCache:
+    """Persistent cache for image descriptions, keyed by the SHA256 hash of the image content
+    and the settings that change the description (see key).
+
+    Args:
+        path (str): The path to the cache database."""
+
+    def __init__(self, path):
+        self.db = shelve.open(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def key(image_bytes, args):
+        """Builds the cache key of an image.
+
+        Args:
+            image_bytes (bytes): The original image stream.
+            args (argparse.Namespace): The arguments from the command line.
+
+        Returns:
+            str: The key."""
+
+        digest = hashlib.sha256(image_bytes)
+        settings = (args.description_prompt, VISION_MODEL, args.vision_detail, str(args.vision_max_dim))
+        digest.update('\0'.join(settings).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def __setitem__(self, key, description):
+        self.db[key] = description
+
+    def close(self):
+        self.db.close()
+
+
 def text_wrap(text, font, max_width):
     """Wrap text to fit a given width to print on an image.
 
@@ -82,32 +241,212 @@ def text_wrap(text, font, max_width):
 
     lines = []
     words = text.split(' ')
-    i = 0
+    # Measure every word once and sum up the widths of the current line
+    widths = [font.getlength(word + ' ') for word in words]
     line = ''
-    while i < len(words):
-        test_line = line + words[i] + ' '
-        bbox = font.getbbox(text)
-        text_width = bbox[2] - bbox[0]
-
-        if text_width > max_width:
+    line_width = 0
+    for word, width in zip(words, widths):
+        if line and line_width + width > max_width:
             lines.append(line.strip())
-            line = words[i] + ' '
-        else:
-            line = test_line
-        i += 1
+            line = ''
+            line_width = 0
+        line += word + ' '
+        line_width += width
     lines.append(line.strip())
     return lines
 
 
+# The kernel of cv2.GaussianBlur grows with the radius, while PIL approximates the blur with box
+# blurs of constant cost. Above this radius PIL is faster.
+CV2_MAX_BLUR_RADIUS = 10
+
+
+def blur_image(pil_img, blur_filter):
+    """Applies a gaussian blur to an image. Uses OpenCV for small radii if it is installed, PIL otherwise.
+
+    Args:
+        pil_img (PIL.Image): The image to blur.
+        blur_filter (PIL.ImageFilter.GaussianBlur): The blur filter (its radius is used as sigma for OpenCV).
+
+    Returns:
+        PIL.Image: The blurred image."""
+
+    if (cv2 is None or np is None or blur_filter.radius >= CV2_MAX_BLUR_RADIUS
+            or pil_img.mode not in ('L', 'RGB', 'RGBA', 'CMYK')):
+        return pil_img.filter(blur_filter)
+
+    sigma = blur_filter.radius
+    ksize = 2 * int(3 * sigma) + 1
+    arr = cv2.GaussianBlur(np.asarray(pil_img), (ksize, ksize), sigmaX=sigma)
+    return Image.fromarray(arr, pil_img.mode)
+
+
+def threshold_image(pil_img, threshold):
+    """Converts an image to black and white with a fixed luminance threshold (no dithering).
+
+    Args:
+        pil_img (PIL.Image): The image to convert.
+        threshold (int): [0-255] Pixels brighter than this become white, all others black.
+
+    Returns:
+        PIL.Image: The black and white image (mode '1')."""
+
+    gray = pil_img.convert('L')
+    if np is None:
+        return gray.point(lambda value: 255 if value > threshold else 0, mode='1')
+
+    # A boolean array is converted to a mode '1' image directly
+    return Image.fromarray(np.asarray(gray) > threshold)
+
+
+def build_pipeline(args):
+    """Builds the list of filters to apply to every image, based on the command line arguments.
+
+    Args:
+        args (argparse.Namespace): The arguments from the command line.
+
+    Returns:
+        list: A list of (name, step) tuples, where step is a function taking and returning a PIL.Image."""
+
+    pipeline = []
+    if args.blur > 0:
+        blur_filter = ImageFilter.GaussianBlur(args.blur)
+        pipeline.append(("Blurring", lambda im: blur_image(im, blur_filter)))
+    if args.emboss:
+        pipeline.append(("Embossing", lambda im: im.filter(ImageFilter.EMBOSS)))
+    # Black/white already includes the luminance conversion, so gray-scaling is skipped
+    if args.black:
+        if args.bw_dither:
+            pipeline.append(("Blackening", lambda im: im.convert('1')))
+        else:
+            pipeline.append(("Blackening", lambda im: threshold_image(im, args.bw_threshold)))
+    elif args.gray:
+        pipeline.append(("Gray-scaling", lambda im: im.convert('L')))
+    return pipeline
+
+
+def transform_image(image_bytes, description, xref, page_num, args, font=None, pipeline=()):
+    """Applies the filters and the description to an image.
+
+    Only PIL is used here (no PyMuPDF), so this can run in a worker thread.
+
+    Args:
+        image_bytes (bytes): The original image stream.
+        description (str): The description to print on the image (only used with --describe).
+        xref (int): The xref of the image (for the debug information).
+        page_num (int): The number of the page (for the debug information).
+        args (argparse.Namespace): The arguments from the command line.
+        font (PIL.ImageFont): The font used for the descriptions.
+        pipeline (list): The filters to apply, see build_pipeline.
+
+    Returns:
+        bytes: The transformed JPEG image, or None if it could not be encoded."""
+
+    pil_img = Image.open(io.BytesIO(image_bytes))
+
+    for name, step in pipeline:
+        pil_img = step(pil_img)
+        if args.verbose:
+            print(f">> {name} image {xref} on page {page_num}")
+
+    if args.describe:
+        draw = ImageDraw.Draw(pil_img)
+        # The text starts at x=10, keep the same margin on the right (including the outline)
+        max_width = pil_img.width - 20 - 2 * args.text_stroke_width
+        lines = text_wrap(description, font, max_width)
+        # Draw all lines at once, with a black outline instead of a separate shadow
+        draw.multiline_text((10, 10), '\n'.join(lines), font=font, fill='white',
+                            stroke_width=args.text_stroke_width, stroke_fill='black')
+
+    buf = io.BytesIO()
+    try:
+        pil_img.save(buf, format='JPEG')
+    except Exception as e:
+        print(e)
+        return None
+    return buf.getvalue()
+
+
+def process_page(doc, page_num, descriptions, executor, args, font=None, pipeline=()):
+    """Collects the images of a single page and submits their transformations to the executor.
+
+    PyMuPDF does not support multithreaded use, so all PyMuPDF calls are made here, in the
+    calling thread. The worker threads of the executor only run the PIL part (transform_image).
+
+    Args:
+        doc (fitz.Document): The document.
+        page_num (int): The number of the page to process.
+        descriptions (dict): The image descriptions, keyed by xref.
+        executor (concurrent.futures.Executor): The executor running transform_image.
+        args (argparse.Namespace): The arguments from the command line.
+        font (PIL.ImageFont): The font used for the descriptions.
+        pipeline (list): The filters to apply, see build_pipeline.
+
+    Returns:
+        list: A list of (bboxes, image) tuples with the transformed images (a fitz.Pixmap or a
+            future of the JPEG bytes) and all places they are shown on the page."""
+
+    results = []
+    page = doc[page_num]
+    if args.verbose:
+        print(f"Processing page {page.number}")
+
+    # Get the images (with their bbox and xref) on the page. An image can be shown several
+    # times, so the placements are grouped by xref and each image is transformed only once.
+    # Inline images have no xref and can't be extracted.
+    placements_by_xref = {}
+    for info in page.get_image_info(xrefs=True):
+        if info['xref'] != 0:
+            placements_by_xref.setdefault(info['xref'], []).append(info['bbox'])
+
+    # Only gray-scaling is possible with PyMuPDF, the other filters need PIL
+    gray_only = not (args.blur > 0 or args.emboss or args.black or args.describe)
+
+    for xref, bboxes in placements_by_xref.items():
+        # Images without filters and description are already in the PDF and are not re-encoded
+        if not pipeline and not descriptions.get(xref):
+            continue
+
+        # Pixmaps are faster for lossless images. JPEG images are gray-scaled with PIL, which is
+        # faster than MuPDF's JPEG encoder and keeps them smaller.
+        is_jpeg = "/DCTDecode" in doc.xref_get_key(xref, "Filter")[1]
+        if gray_only and not is_jpeg:
+            # Images that are already gray or have no colorspace (stencil masks) stay as they are
+            pix = fitz.Pixmap(doc, xref)
+            if pix.colorspace is None or pix.colorspace.n == 1:
+                continue
+            pix = fitz.Pixmap(fitz.csGRAY, pix)
+            if args.verbose:
+                print(f">> Gray-scaling image {xref} on page {page.number}")
+            results.append((bboxes, pix))
+            continue
+
+        base_image = doc.extract_image(xref)
+        if gray_only and base_image["colorspace"] == 1:
+            continue
+
+        # Transform the image in a worker thread
+        results.append((bboxes, executor.submit(transform_image, base_image["image"], descriptions.get(xref),
+                                                xref, page.number, args, font=font, pipeline=pipeline)))
+
+    return results
+
+
 def extract_pdf(args):
     """Extracts images from a PDF file and applies some transformations to them.
 
     Args:
         args (argparse.Namespace): The arguments from the command line."""
 
-    # Create a temporary image path
-    orig_tmp_path = f"o_tmp.jpg"
-    tmp_image_path = f"tmp.jpg"
+    if args.threads < 1:
+        print("Please use at least one thread with the --threads flag.")
+        return
+    if args.concurrency < 1:
+        print("Please allow at least one parallel request with the --concurrency flag.")
+        return
+    if args.describe_batch_size < 1:
+        print("Please use at least one image per request with the --describe-batch-size flag.")
+        return
 
     # Check if the OpenAI key is provided (only if the describe flag is set)
     if args.describe:
@@ -115,88 +454,100 @@ def extract_pdf(args):
             print("Please provide an OpenAI key with the --openai-key flag.")
             return
 
+    # Load the font and create the filters once for all images
+    font = ImageFont.truetype('arial.ttf', args.font_size) if args.describe else None
+    pipeline = build_pipeline(args)
+
     # Open the PDF file
     pdf = args.pdf_file
     doc = fitz.open(pdf)
 
-    # Iterate over the pages
-    for page in doc:
-        if args.verbose:
-            print(f"Processing page {page.number}")
-
-        # Get the images on the page and iterate over them
-        image_list = page.get_images(full=True)
-        for img_index, img in enumerate(image_list):
-            # Create an image to apply the transformations
-            base_image = doc.extract_image(img[0])
-            pil_img = Image.open(io.BytesIO(base_image["image"]))
-
-            # If the describe flag is set, get the description of the image
-            description = None
-            if args.describe:
-                if args.verbose:
-                    print(f">> Describing image {img_index} on page {page.number}")
-
-                # Save the image to a temporary file
-                try:
-                    pil_img.save(orig_tmp_path, format='JPEG')
-                except Exception as e:
-                    print(f"extract_pdf::Error saving image to {orig_tmp_path}: {e}")
-
-                description = get_image_description(orig_tmp_path,
-                                                    args.description_prompt,
-                                                    "gpt-4-vision-preview",
-                                                    args.openai_key,
-                                                    args.max_openai_tokens,
-                                                    is_verbose=args.verbose)
-                if os.path.exists(orig_tmp_path):
-                    os.remove(orig_tmp_path)
-
-            if args.blur > 0:
-                pil_img = pil_img.filter(ImageFilter.GaussianBlur(args.blur))
-                if args.verbose:
-                    print(f">> Blurring image {img_index} on page {page.number}")
-            if args.emboss:
-                pil_img = pil_img.filter(ImageFilter.EMBOSS)
-                if args.verbose:
-                    print(f">> Embossing image {img_index} on page {page.number}")
-            if args.gray:
-                pil_img = pil_img.convert('L')
-                if args.verbose:
-                    print(f">> Gray-scaling image {img_index} on page {page.number}")
-            if args.black:
-                pil_img = pil_img.convert('1')
-                if args.verbose:
-                    print(f">> Blackening image {img_index} on page {page.number}")
-
-            if args.describe:
-                draw = ImageDraw.Draw(pil_img)
-                max_width = pil_img.width
-                font = ImageFont.truetype('arial.ttf', args.font_size)
-                lines = text_wrap(description, font, max_width)
-                y_text = 10
-                for line in lines:
-                    bbox = font.getbbox(line)
-                    text_height = bbox[3] - bbox[1]
-
-                    draw.text((10, y_text), line, font=font, fill='white')
-                    # Draw a shadow
-                    draw.text((10 + 1, y_text + 1), line, font=font, fill='black')
-                    y_text += text_height
-
-            try:
-                pil_img.save(tmp_image_path, format='JPEG')
-            except Exception as e:
-                print(e)
-
-            img_info = page.get_image_info()[img_index]
-            bbox = img_info['bbox']
-            page.insert_image(bbox, filename=tmp_image_path, keep_proportion=True)
-
-        if os.path.exists(tmp_image_path):
-            os.remove(tmp_image_path)
-
-    doc.save(args.output_file)
+    # If the describe flag is set, collect all images first and describe them concurrently
+    descriptions = {}
+    if args.describe:
+        with DescriptionCache(args.cache_path) as cache:
+            images = []
+            placements = {}
+            seen_xrefs = set()
+            for page in doc:
+                for info in page.get_image_info(xrefs=True):
+                    xref = info['xref']
+                    if xref == 0 or xref in seen_xrefs:
+                        continue
+                    seen_xrefs.add(xref)
+                    base_image = doc.extract_image(xref)
+
+                    # Use the cached description, identical images are only described once
+                    key = DescriptionCache.key(base_image["image"], args)
+                    description = cache.get(key)
+                    if description is not None and not args.force_refresh:
+                        descriptions[xref] = description
+                        continue
+                    if key in placements:
+                        placements[key].append(xref)
+                        continue
+
+                    pil_img = Image.open(io.BytesIO(base_image["image"]))
+
+                    # Downscale a copy of the image for the API, the original is kept for the output
+                    thumb = pil_img.copy()
+                    thumb.thumbnail((args.vision_max_dim, args.vision_max_dim), Image.LANCZOS)
+
+                    # Encode the image in memory
+                    buf = io.BytesIO()
+                    try:
+                        thumb.save(buf, format='JPEG', quality=80, optimize=True)
+                    except Exception as e:
+                        print(f"extract_pdf::Error encoding image {xref} on page {page.number}: {e}")
+                        continue
+                    images.append((key, buf.getvalue()))
+                    placements[key] = [xref]
+
+            if args.verbose:
+                print(f">> Describing {len(images)} images")
+            for key, description in asyncio.run(describe_images(images, args)).items():
+                # Failed requests return an empty description and are not cached
+                if description:
+                    cache[key] = description
+                for xref in placements[key]:
+                    descriptions[xref] = description
+
+    # Transform the images in parallel, the images are inserted in this thread. The pages are
+    # processed in windows of --threads pages, so only the images of one window are kept in memory.
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for start in range(0, len(doc), args.threads):
+            window = range(start, min(start + args.threads, len(doc)))
+            results = [process_page(doc, page_num, descriptions, executor, args, font=font, pipeline=pipeline)
+                       for page_num in window]
+
+            # Images shown several times are inserted once and then referenced by their new xref
+            for page_num, page_images in zip(window, results):
+                page = doc[page_num]
+                for bboxes, image in page_images:
+                    if isinstance(image, fitz.Pixmap):
+                        new_xref = page.insert_image(bboxes[0], pixmap=image, keep_proportion=True)
+                    else:
+                        image = image.result()
+                        if image is None:
+                            continue
+                        new_xref = page.insert_image(bboxes[0], stream=image, keep_proportion=True)
+                    for bbox in bboxes[1:]:
+                        page.insert_image(bbox, xref=new_xref, keep_proportion=True)
+
+                # If requested, run the garbage collector
+                if args.gc_every > 0 and (page_num + 1) % args.gc_every == 0:
+                    gc.collect()
+
+            # Release the inserted images and the images cached by MuPDF
+            results = None
+            fitz.TOOLS.store_shrink(100)
+
+    # Remove the replaced image streams and compress the output. A PDF can only be written back
+    # to the input file incrementally, which keeps the replaced streams in the file.
+    if os.path.abspath(args.output_file) == os.path.abspath(pdf):
+        doc.saveIncr()
+    else:
+        doc.save(args.output_file, garbage=4, deflate=True, deflate_images=True, clean=True)
     doc.close()
 
 
@@ -208,12 +559,19 @@ def main():
     parser.add_argument('pdf_file', type=str, help='Input')
 
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose mode')
-    parser.add_argument('-o', '--output-file', type=str, help='Output file', default='output.pdf')
+    parser.add_argument('-o', '--output-file', type=str, default='output.pdf',
+                        help='Output file (unused objects are removed and the streams are recompressed, '
+                             'unless it is the input file, which is updated incrementally)')
 
     parser.add_argument('--blur', type=int, help="[0-50] Apply a blur effect to the images of the PDF.",
                         default=0)
-    parser.add_argument('--gray', action='store_true', help="Gray scale the images of the PDF")
+    parser.add_argument('--gray', action='store_true',
+                        help="Gray scale the images of the PDF (ignored with --black)")
     parser.add_argument('--black', action='store_true', help="Blacken the images of the PDF")
+    parser.add_argument('--bw-threshold', type=int, default=127,
+                        help="[0-255] Luminance threshold for --black (brighter pixels become white)")
+    parser.add_argument('--bw-dither', action='store_true',
+                        help="Use Floyd-Steinberg dithering for --black instead of the threshold")
     parser.add_argument('--emboss', action='store_true',
                         help="Apply a emboss effect to the images of the PDF")
 
@@ -223,7 +581,25 @@ def main():
     parser.add_argument('--description-prompt', type=str, help="Prompt for the description",
                         default='Describe the image in less than 20 words. Include the number of people and objects.')
     parser.add_argument('--max-openai-tokens', type=int, help="Max tokens", default=300)
+    parser.add_argument('--vision-max-dim', type=int,
+                        help="Max width/height of the images sent to OpenAI", default=768)
+    parser.add_argument('--vision-detail', type=str, choices=['low', 'high', 'auto'],
+                        help="Detail level OpenAI uses for the images", default='low')
+    parser.add_argument('--describe-batch-size', type=int, help="Number of images described per OpenAI request",
+                        default=4)
+    parser.add_argument('--concurrency', type=int, help="Max number of parallel OpenAI requests",
+                        default=10)
+    parser.add_argument('--cache-path', type=str, help="Path to the image description cache",
+                        default='.didi_cache.db')
+    parser.add_argument('--force-refresh', action='store_true',
+                        help="Ignore cached image descriptions and request new ones")
     parser.add_argument('--font-size', type=int, help="Font size", default=18)
+    parser.add_argument('--text-stroke-width', type=int, help="Width of the outline around the description",
+                        default=1)
+    parser.add_argument('--threads', type=int, help="Number of images transformed in parallel",
+                        default=min(8, os.cpu_count() or 1))
+    parser.add_argument('--gc-every', type=int, default=0,
+                        help="Run the garbage collector every N pages to limit the memory usage (0: never)")
 
     # Parse the arguments
     args = parser.parse_args()